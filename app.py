@@ -1,20 +1,32 @@
 """
 A Streamlit app to run and debug conda solves online
 """
-import json
+import hashlib
+import logging
 import os
 import re
+import shutil
 import sys
-import tarfile
-import time
 from pathlib import Path
-from subprocess import run, TimeoutExpired
-from urllib.request import urlretrieve
+from subprocess import DEVNULL, PIPE, run, TimeoutExpired
+from threading import Thread
 
+import orjson
 import streamlit as st
+from diskcache import Cache
+
+from app_helpers import (
+    ALLOWED_CHANNELS,
+    MAX_CHARS_PER_LINE,
+    MAX_LINES_PER_REQUEST,
+    lockfile,
+    result_table,
+    validate_packages,
+)
+from app_solver import ROOT_PREFIX, SolverProcess
 
 TITLE = "Online solver for conda packages"
-ALLOWED_CHANNELS = ["conda-forge", "bioconda", "defaults"]
+logger = logging.getLogger(__name__)
 ALLOWED_PLATFORMS = [
     "linux-64",
     "linux-aarch64",
@@ -25,10 +37,9 @@ ALLOWED_PLATFORMS = [
 ]
 ALLOWED_PRIORITIES = ["strict", "flexible", "disabled"]
 TTL = 3600  # seconds
+SOLVE_CACHE_SIZE = 2 << 30  # bytes
 REPODATA_TIMEOUT = 60  # seconds
-SOLVE_TIMEOUT = 30  # seconds
-MAX_CHARS_PER_LINE = 50
-MAX_LINES_PER_REQUEST = 25
+_NUMERIC_RE = re.compile(r"^[0-9\.]+$")
 
 STATEFUL_KEYS = ("platform", "channels", "packages", "priority", "glibc", "cuda", "osx")
 DEFAULT_STATE = {
@@ -62,12 +73,22 @@ def _platform():
     return f"{operating_system}-{arch}"
 
 
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def micromamba():
+    # not MAMBA_EXE: any shell activation sets it, and the cache layout read by
+    # _repodata_path() is only known to hold for the pinned 1.5.1
+    if bundled := os.environ.get("CONDA_SOLVE_APP_MICROMAMBA"):
+        if Path(bundled).is_file():
+            return Path(bundled)
+        logger.warning("CONDA_SOLVE_APP_MICROMAMBA=%s is not a file; ignoring", bundled)
     workdir = Path(__file__).parent
     micromamba_path = workdir / "micromamba"
     if micromamba_path.is_file():
         return micromamba_path
+    if on_path := shutil.which("micromamba"):
+        return Path(on_path)
+    from urllib.request import urlretrieve  # only needed on first download
+
     version = "1.5.1-0"
     url = (
         "https://github.com/mamba-org/micromamba-releases/releases/download/"
@@ -78,7 +99,7 @@ def micromamba():
     return micromamba_path
 
 
-@st.cache_data(ttl=TTL)
+@st.cache_data(ttl=TTL, max_entries=16, show_spinner=False)
 def refresh_repodata(channels, platform):
     cmd = [
         micromamba(),
@@ -86,6 +107,9 @@ def refresh_repodata(channels, platform):
         "--dry-run",
         "--name",
         "test",
+        "--no-rc",
+        "--root-prefix",
+        ROOT_PREFIX,
         "--repodata-ttl",
         f"{TTL}",
         "--platform",
@@ -95,184 +119,96 @@ def refresh_repodata(channels, platform):
     ]
     for channel in channels:
         cmd += ["--channel", channel]
+    env = os.environ.copy()
+    # fetch repodata.json.zst when the channel offers it; much smaller transfers
+    env["MAMBA_REPODATA_USE_ZST"] = "true"
 
-    p = run(cmd, capture_output=True, text=True, timeout=REPODATA_TIMEOUT)
+    try:
+        p = run(cmd, stdout=DEVNULL, stderr=PIPE, timeout=REPODATA_TIMEOUT, env=env)
+    except TimeoutExpired:
+        logger.warning("Refreshing repodata timed out after %ss", REPODATA_TIMEOUT)
+        return
     if p.returncode != 0:
-        st.warning(f"Failed to refresh repodata! {p.stderr}")
+        # the exit code reports on the dummy `xz` solve, not on the downloads
+        # (e.g. bioconda alone cannot solve it); the solver checks the files
+        logger.warning(
+            "Failed to refresh repodata! %s", p.stderr.decode(errors="replace")
+        )
+
+
+@st.cache_resource(show_spinner=False)
+def solver():
+    return SolverProcess()
 
 
-@st.cache_data(ttl=TTL)
+@st.cache_resource
+def solve_cache():
+    return Cache(
+        str(Path(__file__).parent / ".solve-cache"), size_limit=SOLVE_CACHE_SIZE
+    )
+
+
+# In-memory caches are bounded (max_entries evicts least recently used) so a
+# public deployment does not grow until it is killed for exceeding its memory
+# limit. Evicted solves fall back to the on-disk cache. Pools, held by the
+# solver process, are by far the largest: a single conda-forge subdir plus
+# noarch takes hundreds of MB once parsed, and each channel combination gets its
+# own copy. Only MAX_POOLS (two) stay resident (e.g. the prewarmed
+# conda-forge/linux-64 and the latest other request); switching between more
+# combinations re-parses repodata, trading a few seconds per solve for a bounded
+# footprint.
+@st.cache_data(ttl=TTL, max_entries=256)
 def solve(
     packages,
     channels=("conda-forge",),
     platform="linux-64",
     priority="strict",
-    virtual_packages=None,
+    virtual_packages=(),
 ):
-    refresh_repodata(sorted(channels), platform)
-    cmd = [
-        micromamba(),
-        "create",
-        "--dry-run",
-        "--name",
-        "test",
-        "--repodata-ttl",
-        f"{TTL}",
-        "--platform",
-        platform,
-        "--override-channels",
-        "--channel-priority",
-        priority,
-    ]
-    for channel in channels:
-        cmd += ["--channel", channel]
-    cmd += packages
-    env = os.environ.copy()
-    for k, v in (virtual_packages or {}).items():
-        if v:
-            env["CONDA_OVERRIDE_" + k.upper()] = v
-    t0 = time.time()
-    p = run(
-        [*cmd, "--json"], capture_output=True, text=True, timeout=SOLVE_TIMEOUT, env=env
-    )
-    time_taken = time.time() - t0
-    try:
-        result = json.loads(p.stdout)
-    except json.JSONDecodeError:
-        return {
-            "success": False,
-            "stdout": p.stdout,
-            "stderr": p.stderr,
-            "returncode": p.returncode,
-            "cmd": cmd,
-            "virtual_packages": virtual_packages or {},
-            "stats": {"time_taken": time_taken},
-        }
-    result["stats"] = {"time_taken": time_taken}
-    if result.get("solver_problems"):
-        # augment with explained problems, not available in JSON output :shrug:
-        p = run(
-            [*cmd, "--quiet"],
-            capture_output=True,
-            text=True,
-            timeout=SOLVE_TIMEOUT,
-            env=env,
-        )
-        error_lines = None
-        for line in p.stderr.splitlines():
-            line = line.rstrip()
-            if "Could not solve for environment specs" in line:
-                if error_lines is None:
-                    error_lines = []
-                    continue
-                break
-            if error_lines is not None:
-                error_lines.append(line)
-        result["explained_problems"] = "\n".join(error_lines)
-        return result
+    """
+    Arguments are expected in canonical form (tuples of strings, with
+    virtual_packages as sorted (name, version) pairs and unset versions left
+    out), so st.cache_data hashes a small tuple and equivalent requests share
+    one cache entry.
+
+    Results are also persisted on disk so they survive restarts. Disk
+    entries expire after TTL, like the in-memory ones, so a disk hit needs
+    no repodata refresh and never runs a subprocess.
+    """
+    key = hashlib.blake2b(
+        orjson.dumps([packages, channels, platform, priority, virtual_packages])
+    ).hexdigest()
+    cached = solve_cache().get(key)
+    if cached is not None:
+        return cached
+    # the solver process rebuilds its pool if this downloads newer repodata
+    refresh_repodata(tuple(sorted(channels)), platform)
+    result = solver().solve(packages, channels, platform, priority, virtual_packages)
+    solve_cache().set(key, result, expire=TTL)
     return result
 
 
-def _readable_size(num, suffix="B"):
-    "https://stackoverflow.com/a/1094933"
-    for unit in ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"):
-        if abs(num) < 1024.0:
-            return f"{num:3.1f} {unit}{suffix}"
-        num /= 1024.0
-    return f"{num:.1f} Yi{suffix}"
-
-
-def result_table(packages, specs):
-    table = [
-        "| Name | Version | Build | Subdir | Channel | Size |",
-        "|:-----|:------- |:------|:-------|---------|:------:|",
-    ]
-    total_size = 0
-    spec_names = set()
-    for spec in specs:
-        name = (
-            spec.split("=")[0]
-            .split(">")[0]
-            .split("<")[0]
-            .split("!")[0]
-            .split("::")[-1]
-            .lower()
-        )
-        spec_names.add(name.lower())
-
-    for pkg in sorted(packages, key=lambda x: x["name"]):
-        name = pkg["name"]
-        table.append(
-            " | ".join(
-                [
-                    (f"**{name}**" if name.lower() in spec_names else name),
-                    f"`{pkg['version']}`",
-                    f"`{pkg['build']}`",
-                    f"`{pkg['subdir']}`",
-                    f"[{pkg['channel'].rsplit('/', 2)[-2]}]({pkg['url']})",
-                    f"`{_readable_size(pkg['size'])}`",
-                ],
-            )
-        )
-        total_size += pkg["size"]
-    table.append(
-        f" **{len(packages)} packages** | | | "
-        f"| **Total size:** | **{_readable_size(total_size)}**"
+@st.cache_resource
+def prewarm(channels=("conda-forge",), platform="linux-64"):
+    """
+    Start the solver process, then fetch micromamba and build the most commonly
+    requested pool in the background, once per process, so the first user does
+    not wait for it.
+    """
+    thread = Thread(
+        target=_prewarm_pool, args=(solver(), channels, platform), daemon=True
     )
-    return "\n".join(table)
-
-
-def lockfile(packages, platform):
-    lines = [
-        "# This file may be used to create an environment using:",
-        "# $ conda create --name <env> --file <this file>",
-        f"# platform: {platform}",
-        "@EXPLICIT",
-    ]
-    for pkg in packages:
-        lines.append(f"{pkg['url']}#{pkg['md5']}")
-    return "\n".join(lines)
+    thread.start()
+    return thread
 
 
-def validate_package(line):
-    line = line.strip().lower()
-    if line.startswith("#"):
-        return
-    if not line:
-        return
-    if len(line) > MAX_CHARS_PER_LINE:
-        raise ValueError("Line too long.")
-    if " " in line:
-        raise ValueError(f"Spaces not allowed in package spec: `{line}`")
-    if "::" in line and (channel := line.split("::")[0]) not in ALLOWED_CHANNELS:
-        raise ValueError(
-            f"Specified channel `{channel}` is not allowed. "
-            f"Use one of: {', '.join(ALLOWED_CHANNELS)}."
-        )
-    if line.startswith("-"):
-        raise ValueError(f"Invalid package spec: `{line}`.")
-    if line.lower().startswith(("http://", "https://", "file://", "ftp://", "s3://")):
-        raise ValueError(f"URLs not allowed: `{line}`.")
-    if line.startswith("*"):
-        raise ValueError(f"Wildcards not allowed: `{line}`.")
-    if not re.match(r"^[a-zA-Z0-9_\-\.\*=!><,|;\[\]/]+$", line):
-        raise ValueError(f"Invalid characters in package spec: `{line}`.")
-    return line
-
-
-def validate_packages(packages):
-    if len(packages) > MAX_LINES_PER_REQUEST:
-        raise ValueError(
-            f"Too many packages requested. Maximum is {MAX_LINES_PER_REQUEST}. "
-        )
-    pkgs = []
-    for pkg in packages:
-        pkg = validate_package(pkg)
-        if pkg:
-            pkgs.append(pkg)
-    if not pkgs:
-        raise ValueError("No valid packages specified.")
-    return pkgs
+def _prewarm_pool(solver_process, channels, platform):
+    try:
+        refresh_repodata(channels, platform)
+        solver_process.load(channels, platform)
+    except Exception:
+        # nothing was cached; the first request will retry and show the error
+        logger.exception("Prewarming the %s pool for %s failed", channels, platform)
 
 
 def parse_url_params():
@@ -305,7 +241,7 @@ def parse_url_params():
                     f"Use one of: {', '.join(ALLOWED_PRIORITIES)}."
                 )
                 continue
-            elif key in ("glibc", "cuda", "osx") and not re.match(r"^[0-9\.]+$", value):
+            elif key in ("glibc", "cuda", "osx") and not _NUMERIC_RE.match(value):
                 st.error(f"Invalid value for `{key}`: `{value}`")
                 continue
             elif key == "packages" and len(value.splitlines()) > MAX_LINES_PER_REQUEST:
@@ -337,6 +273,7 @@ def initialize_state():
 # ---
 # Streamlit app starts here
 
+prewarm()
 initialization_error = initialize_state()
 st.title(f":snake: {TITLE}", anchor="top")
 
@@ -355,7 +292,10 @@ with st.sidebar:
     )
     packages = st.text_area(
         "Packages *",
-        help=f"Specify up to {MAX_LINES_PER_REQUEST} packages, one per line.",
+        help=(
+            f"Specify up to {MAX_LINES_PER_REQUEST} packages, one per line. "
+            "Narrow specs (e.g. `numpy=1.26` instead of `numpy`) solve faster."
+        ),
         placeholder="python=3\nnumpy>=1.18.1=*py38*\nscipy[build=*py38*]",
         max_chars=MAX_CHARS_PER_LINE * MAX_LINES_PER_REQUEST,
         key="packages",
@@ -384,7 +324,13 @@ with st.sidebar:
 
 if ok or enabled:
     try:
-        specs = validate_packages(packages.splitlines())
+        # widget changes rerun the whole script; only revalidate changed input
+        if st.session_state.get("_last_packages_raw") != packages:
+            specs = validate_packages(packages.splitlines())
+            st.session_state["_last_specs"] = specs
+            st.session_state["_last_sorted_specs"] = tuple(sorted(specs))
+            st.session_state["_last_packages_raw"] = packages
+        specs = st.session_state["_last_specs"]
     except ValueError as e:
         st.error(e)
         st.stop()
@@ -397,11 +343,13 @@ if ok or enabled:
     )
     try:
         result = solve(
-            sorted(specs),
-            channels=channels,
+            st.session_state["_last_sorted_specs"],
+            channels=tuple(channels),
             platform=platform,
             priority=priority,
-            virtual_packages=virtual_packages,
+            virtual_packages=tuple(
+                sorted((k, v) for k, v in virtual_packages.items() if v)
+            ),
         )
     except TimeoutExpired:
         st.error(
@@ -428,7 +376,9 @@ if ok or enabled:
     else:
         st.error("Unknown error. Check the full JSON result below.")
     with st.expander("Full JSON result"):
-        st.code(json.dumps(result, indent=2), language="json")
+        st.code(
+            orjson.dumps(result, option=orjson.OPT_INDENT_2).decode(), language="json"
+        )
     st.markdown(f"> ⌛️ _Solver took {result['stats']['time_taken']:.3f} seconds_.")
 elif initialization_error:
     st.info("There were errors initializing the app. Check your URL.")
@@ -0,0 +1,109 @@
+"""
+Pure helpers for the Streamlit app: validation and rendering of solve results.
+They do not depend on Streamlit, so mypyc can compile this module with
+`pixi run -e build compile`; app.py imports the compiled extension when built.
+"""
+from operator import itemgetter
+from typing import Any, Final
+
+ALLOWED_CHANNELS: Final = ["conda-forge", "bioconda", "defaults"]
+MAX_CHARS_PER_LINE: Final = 50
+MAX_LINES_PER_REQUEST: Final = 25
+# specs are lowercased before validation, so no uppercase letters here
+_SPEC_CHARS: Final = frozenset("abcdefghijklmnopqrstuvwxyz0123456789_-.*=!><,|;[]/")
+_URL_PREFIXES: Final = ("http://", "https://", "file://", "ftp://", "s3://")
+_SIZE_UNITS: Final = ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi", "Yi")
+
+
+def _readable_size(num: float, suffix: str = "B") -> str:
+    "https://stackoverflow.com/a/1094933, with the unit picked from the bit length"
+    index = min(max(int(abs(num)).bit_length() - 1, 0) // 10, len(_SIZE_UNITS) - 1)
+    return f"{num / (1 << (10 * index)):3.1f} {_SIZE_UNITS[index]}{suffix}"
+
+
+def result_table(packages: list[dict[str, Any]], specs: list[str]) -> str:
+    spec_names: set[str] = set()
+    for spec in specs:
+        name = (
+            spec.split("=")[0]
+            .split(">")[0]
+            .split("<")[0]
+            .split("!")[0]
+            .split("::")[-1]
+            .lower()
+        )
+        spec_names.add(name.lower())
+
+    def name_cell(name: str) -> str:
+        return f"**{name}**" if name.lower() in spec_names else name
+
+    rows = [
+        f"{name_cell(pkg['name'])} | `{pkg['version']}`"
+        f" | `{pkg['build']}` | `{pkg['subdir']}`"
+        f" | [{pkg['channel'].rsplit('/', 2)[-2]}]({pkg['url']})"
+        f" | `{_readable_size(pkg['size'])}`"
+        for pkg in sorted(packages, key=itemgetter("name"))
+    ]
+    total_size = sum(map(itemgetter("size"), packages))
+    return "\n".join(
+        [
+            "| Name | Version | Build | Subdir | Channel | Size |",
+            "|:-----|:------- |:------|:-------|---------|:------:|",
+            *rows,
+            f" **{len(packages)} packages** | | | "
+            f"| **Total size:** | **{_readable_size(total_size)}**",
+        ]
+    )
+
+
+def lockfile(packages: list[dict[str, Any]], platform: str) -> str:
+    lines = [
+        "# This file may be used to create an environment using:",
+        "# $ conda create --name <env> --file <this file>",
+        f"# platform: {platform}",
+        "@EXPLICIT",
+    ]
+    for pkg in packages:
+        lines.append(f"{pkg['url']}#{pkg['md5']}")
+    return "\n".join(lines)
+
+
+def validate_package(line: str) -> str | None:
+    line = line.strip().lower()
+    if line.startswith("#"):
+        return None
+    if not line:
+        return None
+    if len(line) > MAX_CHARS_PER_LINE:
+        raise ValueError("Line too long.")
+    if " " in line:
+        raise ValueError(f"Spaces not allowed in package spec: `{line}`")
+    if "::" in line and (channel := line.split("::")[0]) not in ALLOWED_CHANNELS:
+        raise ValueError(
+            f"Specified channel `{channel}` is not allowed. "
+            f"Use one of: {', '.join(ALLOWED_CHANNELS)}."
+        )
+    if line.startswith("-"):
+        raise ValueError(f"Invalid package spec: `{line}`.")
+    if line.lower().startswith(_URL_PREFIXES):
+        raise ValueError(f"URLs not allowed: `{line}`.")
+    if line.startswith("*"):
+        raise ValueError(f"Wildcards not allowed: `{line}`.")
+    if not _SPEC_CHARS.issuperset(line):
+        raise ValueError(f"Invalid characters in package spec: `{line}`.")
+    return line
+
+
+def validate_packages(packages: list[str]) -> list[str]:
+    if len(packages) > MAX_LINES_PER_REQUEST:
+        raise ValueError(
+            f"Too many packages requested. Maximum is {MAX_LINES_PER_REQUEST}. "
+        )
+    pkgs: list[str] = []
+    for pkg in packages:
+        spec = validate_package(pkg)
+        if spec:
+            pkgs.append(spec)
+    if not pkgs:
+        raise ValueError("No valid packages specified.")
+    return pkgs
@@ -0,0 +1,293 @@
+"""
+The libsolv side of the app. Pools live in a single long-lived child process
+that runs one solve at a time, so a pathological request can be killed after
+SOLVE_TIMEOUT without forking the multi-threaded Streamlit server. This module
+does not import Streamlit; the child runs it as a script.
+"""
+import socket
+import sys
+import time
+from multiprocessing.connection import Connection
+from pathlib import Path
+from subprocess import Popen, TimeoutExpired
+from threading import Lock
+
+from libmambapy import cache_fn_url
+from libmambapy.solver import ProblemsMessageFormat, Request
+from libmambapy.solver.libsolv import (
+    Database,
+    PipAsPythonDependency,
+    Priorities,
+    Solver,
+    UnSolvable,
+)
+from libmambapy.specs import (
+    Channel,
+    ChannelResolveParams,
+    CondaURL,
+    MatchSpec,
+    PackageInfo,
+)
+from libmambapy.utils import TextStyle
+
+CHANNEL_ALIAS = "https://conda.anaconda.org"
+CHANNEL_URLS = {
+    "conda-forge": [f"{CHANNEL_ALIAS}/conda-forge"],
+    "bioconda": [f"{CHANNEL_ALIAS}/bioconda"],
+    "defaults": [
+        "https://repo.anaconda.com/pkgs/main",
+        "https://repo.anaconda.com/pkgs/r",
+    ],
+}
+ARCHSPEC = {
+    "64": "x86_64",
+    "aarch64": "aarch64",
+    "ppc64le": "ppc64le",
+    "arm64": "arm64",
+}
+ROOT_PREFIX = Path(__file__).parent / ".micromamba"
+MAX_POOLS = 2
+SOLVE_TIMEOUT = 30  # seconds
+
+
+class SolverProcess:
+    """
+    Client for the solver process, shared by all sessions. The process is
+    started with subprocess rather than multiprocessing: fork is unsafe in the
+    threaded server (and on macOS), and spawn would re-run the Streamlit
+    script, which is the __main__ module, in the child.
+
+    Solves are serialized: the process holds the pools and solves one request
+    at a time. When a solve times out, the process is restarted and its pools
+    are rebuilt on demand.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._start()
+
+    def _start(self):
+        parent_sock, child_sock = socket.socketpair()
+        with child_sock:
+            self._process = Popen(
+                [sys.executable, __file__, str(child_sock.fileno())],
+                pass_fds=(child_sock.fileno(),),
+            )
+        self._conn = Connection(parent_sock.detach())
+
+    def _restart(self):
+        self._conn.close()
+        self._process.kill()
+        self._process.wait()
+        self._start()
+
+    def load(self, channels, platform):
+        "Build the pool for channels and platform, or rebuild it if stale."
+        with self._lock:
+            self._request(channels, platform, None)
+
+    def solve(self, packages, channels, platform, priority, virtual_packages):
+        """
+        Raises TimeoutExpired when libsolv takes longer than SOLVE_TIMEOUT.
+        Loading the pool does not count towards the timeout.
+        """
+        with self._lock:
+            self._request(
+                channels, platform, (packages, priority, dict(virtual_packages))
+            )
+            if not self._conn.poll(SOLVE_TIMEOUT):
+                self._restart()
+                raise TimeoutExpired("libsolv", SOLVE_TIMEOUT)
+            return self._receive()
+
+    def _request(self, channels, platform, job):
+        if self._process.poll() is not None:
+            self._restart()  # e.g. killed for exceeding the memory limit
+        self._conn.send((channels, platform, job))
+        self._receive()  # the pool is ready
+
+    def _receive(self):
+        try:
+            succeeded, result = self._conn.recv()
+        except EOFError:
+            returncode = self._process.wait()
+            self._restart()
+            raise RuntimeError(f"Solver exited unexpectedly (code {returncode})")
+        if not succeeded:
+            raise RuntimeError(result)
+        return result
+
+
+def _channel_urls(channels, platform):
+    for channel in channels:
+        for base_url in CHANNEL_URLS[channel]:
+            for subdir in (platform, "noarch"):
+                yield channel, f"{base_url}/{subdir}"
+
+
+def _repodata_path(url):
+    return ROOT_PREFIX / "pkgs" / "cache" / cache_fn_url(f"{url}/repodata.json")
+
+
+def _repodata_mtime(channels, platform):
+    mtime = 0
+    for _, url in _channel_urls(channels, platform):
+        path = _repodata_path(url)
+        if path.is_file():
+            mtime = max(mtime, path.stat().st_mtime)
+    return mtime
+
+
+def _channel_params(platform):
+    return ChannelResolveParams(
+        platforms={platform, "noarch"},
+        channel_alias=CondaURL.parse(CHANNEL_ALIAS),
+        custom_multichannels=ChannelResolveParams.MultiChannelMap(
+            {
+                name: [
+                    Channel(CondaURL.parse(url), url, {platform, "noarch"})
+                    for url in urls
+                ]
+                for name, urls in CHANNEL_URLS.items()
+                if len(urls) > 1
+            }
+        ),
+    )
+
+
+def _get_pool(pools, channels, platform):
+    """
+    Return the pool for channels and platform from pools, which keeps at most
+    MAX_POOLS of them, most recently used last. A pool is rebuilt as soon as
+    newer repodata is on disk.
+    """
+    key = (channels, platform)
+    repodata_mtime = _repodata_mtime(channels, platform)
+    pool = pools.pop(key, None)
+    if pool is None or pool[0] < repodata_mtime:
+        pool = None  # free a stale pool before parsing its replacement
+        while len(pools) >= MAX_POOLS:
+            del pools[next(iter(pools))]
+        pool = (repodata_mtime, *_build_pool(channels, platform))
+    pools[key] = pool
+    return pool[1:]
+
+
+def _build_pool(channels, platform):
+    """
+    Load the cached repodata for channels into a libsolv database. Repos are
+    returned per channel, along with their subpriority (platform subdirs rank
+    above noarch), so each solve can apply its own channel order.
+    """
+    db = Database(_channel_params(platform))
+    repos = {channel: [] for channel in channels}
+    for channel, url in _channel_urls(channels, platform):
+        path = _repodata_path(url)
+        if not path.is_file():
+            if url.endswith("/noarch"):
+                # never cache (or solve against) a pool with a channel missing
+                raise FileNotFoundError(f"No cached repodata found for `{url}`!")
+            # not every channel publishes every subdir (e.g. bioconda/win-64)
+            continue
+        repo = db.add_repo_from_repodata_json(
+            path, url, channel, PipAsPythonDependency.Yes
+        )
+        repos[channel].append((repo, 0 if url.endswith("/noarch") else 1))
+    return db, repos
+
+
+def _virtual_packages(platform, virtual_packages):
+    records = [
+        PackageInfo(name=f"__{k}", version=v, build_string="0")
+        for k, v in virtual_packages.items()
+    ]
+    if not platform.startswith("win-"):
+        records.append(PackageInfo(name="__unix", version="0", build_string="0"))
+    arch = ARCHSPEC[platform.split("-")[1]]
+    records.append(PackageInfo(name="__archspec", version="1", build_string=arch))
+    return records
+
+
+def _link_record(pkg):
+    return {
+        "name": pkg.name,
+        "version": pkg.version,
+        "build": pkg.build_string,
+        "build_number": pkg.build_number,
+        "subdir": pkg.platform,
+        "channel": pkg.package_url.rsplit("/", 1)[0],
+        "fn": pkg.filename,
+        "url": pkg.package_url,
+        "md5": pkg.md5,
+        "size": pkg.size,
+    }
+
+
+def _run_solver(db, repos, packages, channels, platform, priority, virtual_packages):
+    request = Request(
+        [Request.Install(MatchSpec.parse(pkg)) for pkg in packages],
+        Request.Flags(strict_repo_priority=priority == "strict"),
+    )
+    for rank, channel in enumerate(reversed(channels)):
+        for repo, subpriority in repos[channel]:
+            db.set_repo_priority(
+                repo, Priorities(0 if priority == "disabled" else rank, subpriority)
+            )
+    virtual_repo = db.add_repo_from_packages(
+        _virtual_packages(platform, virtual_packages), name="virtual"
+    )
+    db.set_installed_repo(virtual_repo)
+    try:
+        t0 = time.time()
+        outcome = Solver().solve(db, request)
+        time_taken = time.time() - t0
+        if isinstance(outcome, UnSolvable):
+            # plain text, without the ANSI colors meant for terminals
+            problems_format = ProblemsMessageFormat()
+            problems_format.unavailable = problems_format.available = TextStyle()
+            return {
+                "success": False,
+                "solver_problems": outcome.problems(db),
+                "explained_problems": outcome.explain_problems(db, problems_format),
+                "virtual_packages": virtual_packages,
+                "stats": {"time_taken": time_taken},
+            }
+        return {
+            "success": True,
+            "actions": {"LINK": [_link_record(pkg) for pkg in outcome.to_install()]},
+            "virtual_packages": virtual_packages,
+            "stats": {"time_taken": time_taken},
+        }
+    finally:
+        # the pool outlives this request; the next one brings its own
+        db.remove_repo(virtual_repo)
+
+
+def _serve(fd):
+    "Answer SolverProcess requests until the app closes its end."
+    conn = Connection(fd)
+    pools = {}
+    while True:
+        try:
+            channels, platform, job = conn.recv()
+        except EOFError:
+            return
+        try:
+            _handle(conn, pools, channels, platform, job)
+        except Exception as e:
+            conn.send((False, f"{e.__class__.__name__}: {e}"))
+
+
+def _handle(conn, pools, channels, platform, job):
+    db, repos = _get_pool(pools, tuple(sorted(channels)), platform)
+    conn.send((True, None))
+    if job is not None:
+        packages, priority, virtual_packages = job
+        result = _run_solver(
+            db, repos, packages, channels, platform, priority, virtual_packages
+        )
+        conn.send((True, result))
+
+
+if __name__ == "__main__":
+    _serve(int(sys.argv[1]))